@@ -1,14 +1,44 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 import sys
 import os
+import re
+import pickle
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
+from multiprocessing import Pool
 from nltk.stem.porter import PorterStemmer
 from nltk.corpus import stopwords
 
 CRAN_COLL = '/Users/iraklis/Datasets/cran/cran.all.1400'
-INDEX_FILE = 'cran.ind'
+# The Boolean and Ranked modules store their indexes in different formats
+# (sorted lists here, numpy arrays there), so each keeps its own files.
+INDEX_FILE = 'cran.bool.ind'
+TOKENS_FILE = 'cran.bool.tokens.pkl'
 
 SYMBOLS = '!@#$%^&*()[]{};\':",.<>/?`~-_=+'
 
+# Pre-compiled patterns for the Cranfield section markers: documents start
+# with ".I <id>", the title sits between ".T" and ".A" and the body runs
+# from ".W" to the next document.
+DOC_SEP_RE = re.compile(r'\.I (\d+)\n')
+TITLE_RE = re.compile(r'\.T\n(.*?)\n\.A\n', re.DOTALL)
+BODY_RE = re.compile(r'\.W\n(.*)', re.DOTALL)
+
+# Loading the stop-word corpus and building the stemmer are expensive, so do
+# both once at import time instead of on every pre_process() call. The
+# translation table deletes every symbol in one C-level str.translate call.
+STOP_WORDS = frozenset(stopwords.words('english'))
+STEMMER = PorterStemmer()
+SYMBOLS_TABLE = str.maketrans('', '', SYMBOLS)
+
+
+@lru_cache(maxsize=100000)
+def _stem(word):
+    """Stem `word`, memoizing the result: the collection repeats the same
+    tokens over and over, so most stem calls are cache hits."""
+    return STEMMER.stem(word)
+
 
 def parse_documents(cran_file=CRAN_COLL):
     """Parse the document body and title fields of the Cranfield collection.
@@ -18,33 +48,19 @@ def parse_documents(cran_file=CRAN_COLL):
         (body_kwds, title_kwds): where body_kwds and title_kwds are
         dictionaries of the form {docId: [words]}.
     """
-    running_idx = -1
-    in_text = False
-    in_title = False
     id_body_list = {}
     id_title_list = {}
-    f = open(cran_file)
-    for line in f:
-        if line.startswith('.I'):
-            in_text = False
-            running_idx = int(line[2:])
-        elif line.startswith('.A'):
-            in_title = False
-        elif line.startswith('.W'):
-            in_text = True
-            line = line[2:]  # Do away with 2-char delimiters on 1st lines
-            id_body_list[running_idx] = []
-        elif line.startswith('.T'):
-            in_title = True
-            line = line[2:]
-            id_title_list[running_idx] = []
-        else:
-            pass  # Good practice
-        if in_text:
-            id_body_list[running_idx] += line.split()
-        if in_title:
-            id_title_list[running_idx] += line.split()
-    f.close()
+    with open(cran_file) as f:
+        text = f.read()
+    # Split the whole file once on the ".I <id>" markers; the pieces then
+    # alternate between a document id and that document's contents.
+    pieces = DOC_SEP_RE.split(text)[1:]
+    for doc_id, contents in zip(pieces[::2], pieces[1::2]):
+        doc_id = int(doc_id)
+        title = TITLE_RE.search(contents)
+        body = BODY_RE.search(contents)
+        id_title_list[doc_id] = title.group(1).split() if title else []
+        id_body_list[doc_id] = body.group(1).split() if body else []
     # assert len(id_body_list) == len(id_title_list)
     # assert sorted(id_body_list.keys()) == sorted(id_title_list.keys())
     return id_body_list, id_title_list
@@ -57,84 +73,179 @@ def pre_process(words):
     Return:
         a shorter list of pre-processed words
     """
-    # Get list of stop-words and instantiate a stemmer:
-    stop_words = set(stopwords.words('english'))
-    stemmer = PorterStemmer()
+    # Lower-case and remove symbols (one C-level translate per token), then
+    # drop words <= 3 characters and stopwords, and stem what remains
+    # (cached -- see _stem above) -- all in a single pass:
+    cleaned = (t.lower().translate(SYMBOLS_TABLE) for t in words)
+    return [_stem(t) for t in cleaned if len(t) > 3 and t not in STOP_WORDS]
 
-    # Make all lower-case:
-    lst = [t.lower() for t in words]
-    # Remove symbols:
-    lst = [''.join([c if c not in SYMBOLS else '' for c in t]) for t in lst]
-    # Remove words <= 3 characters:
-    lst = [t for t in lst if len(t) > 3]
-    # Remove stopwords:
-    lst = [t for t in lst if t not in stop_words]
-    # Stem terms:
-    lst = map(stemmer.stem, lst)
 
-    return lst
+def _pp_one(item):
+    """Pre-process a single (doc_id, words) pair. Module-level so it pickles
+    cleanly for the multiprocessing workers."""
+    doc_id, words = item
+    return doc_id, pre_process(words)
+
+
+def load_tokens(cran_file=CRAN_COLL, tokens_file=TOKENS_FILE):
+    """Parse and pre-process the collection, caching the result on disk.
+    The sidecar pickle stores the source file's modification time along with
+    the pre-processed keyword dictionaries, so repeated index builds skip the
+    parsing and stemming work unless the collection itself changed.
+    Arguments:
+        cran_file: (str) the path to the Cranfield collection file
+        tokens_file: (str) the path of the token cache sidecar
+    Return:
+        (body_kwds, title_kwds): dictionaries of the form {docId: [terms]}
+        with pre-processed terms.
+    """
+    mtime = os.path.getmtime(cran_file)
+    if os.path.isfile(tokens_file):
+        with open(tokens_file, 'rb') as f:
+            cached_mtime, body_kwds, title_kwds = pickle.load(f)
+        if cached_mtime == mtime:
+            return body_kwds, title_kwds
+    body_kwds, title_kwds = parse_documents(cran_file)
+    # Pre-processing is independent per document, so fan it out over the
+    # available cores; this only runs on the cold index-build path.
+    with Pool() as pool:
+        body_kwds = dict(pool.imap_unordered(_pp_one, body_kwds.items(),
+                                             chunksize=64))
+        title_kwds = dict(pool.imap_unordered(_pp_one, title_kwds.items(),
+                                              chunksize=64))
+    with open(tokens_file, 'wb') as f:
+        pickle.dump((mtime, body_kwds, title_kwds), f, protocol=4)
+    return body_kwds, title_kwds
 
 
 def create_inv_index(bodies, titles):
     """Create a single inverted index for the dictionaries provided. Treat
     all keywords as if they come from the same field.
     Arguments:
-        bodies: A dictionary of the form {doc_id: [terms]} for the terms found
-        in the body (.W) of a document
-        titles: A dictionary of the form {doc_id: [terms]} for the terms found
-        in the title (.T) of a document
+        bodies: A dictionary of the form {doc_id: [terms]} for the
+        pre-processed terms found in the body (.W) of a document
+        titles: A dictionary of the form {doc_id: [terms]} for the
+        pre-processed terms found in the title (.T) of a document
     Return:
-        index: a dictionary {docId: [df, postings]}, where postings is a
-        dictionary {docId: tf}.
-        E.g. {'word': [3, {4: 2, 7: 1, 9: 3}]}
-               ^       ^   ^        ^
-               term    df  docid    tf
+        index: a dictionary {term: (df, doc_ids, tfs)}, where doc_ids is the
+        sorted list of ids of the documents containing the term and tfs is a
+        parallel list of term frequencies.
+        E.g. {'word': (3, [4, 7, 9], [2, 1, 3])}
+               ^       ^   ^          ^
+               term    df  docids     tfs
     """
-    # Create a joint dictionary with pre-processed terms
+    # Count each document's joint body+title terms with a Counter, then merge
+    # into the global index: one postings entry and one df increment per
+    # (term, document) pair.
     inv_ind = {}
     for doc_id in bodies:
-        all_terms = bodies[doc_id] + titles[doc_id]
-        joint_terms = pre_process(all_terms)
-        for t in joint_terms:
-            if t not in inv_ind:
-                inv_ind[t] = [1, {doc_id: 1}]  # initial entry for term
-            else:
-                if doc_id not in inv_ind[t][1]:
-                    inv_ind[t][1][doc_id] = 1
-                else:
-                    inv_ind[t][1][doc_id] += 1
-                inv_ind[t][0] = len(inv_ind[t][1])  # Update df
-    return inv_ind
+        joint_terms = bodies[doc_id] + titles[doc_id]
+        for t, tf in Counter(joint_terms).items():
+            entry = inv_ind.setdefault(t, [0, {}])
+            entry[0] += 1  # df: this is t's first occurrence in doc_id
+            entry[1][doc_id] = tf
+    # Convert each term's postings into parallel sorted lists of doc ids and
+    # term frequencies: sorted lists intersect by binary search in eval_conj
+    # without the per-entry overhead of one dictionary per term.
+    inv_index = {}
+    for t, (df, postings) in inv_ind.items():
+        sorted_ids = sorted(postings)
+        inv_index[t] = (df, sorted_ids, [postings[d] for d in sorted_ids])
+    build_blooms(inv_index)
+    return inv_index
+
+
+# Cache of already-loaded indexes, keyed by filename. Each entry holds the
+# file's mtime at load time, so a rebuilt index file invalidates the cache.
+_index_cache = {}
 
 
 def load_inv_index(filename=INDEX_FILE):
-    """Load an inverted index from the disk. The index is assummed to be stored
-    in a text file with one line per keyword. Each line is expected to be
-    `eval`ed into a dictionary of the form created by create_inv_index().
+    """Load an inverted index from the disk. The index is assummed to be
+    stored as a single pickled dictionary of the form created by
+    create_inv_index(). Repeated loads of an unchanged file are served from
+    an in-process cache.
 
     Arguments:
         filename: the path of the inverted index file
     Return:
         a dictionary containing all keyworks and their posting dictionaries
     """
-    inv_ind = {}
-    f = open(filename)
-    for line in f:
-        inv_ind.update(eval(line))
-    f.close()
+    mtime = os.path.getmtime(filename)
+    cached = _index_cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(filename, 'rb') as f:
+        inv_ind = pickle.load(f)
+    build_blooms(inv_ind)
+    _index_cache[filename] = (mtime, inv_ind)
     return inv_ind
 
 
 def write_inv_index(inv_index, outfile=INDEX_FILE):
-    """Write the given inverted index in a file.
+    """Write the given inverted index in a file, as a single pickled
+    dictionary (pickle keeps the integer doc ids intact).
     Arguments:
-        inv_index: an inverted index of the form {'term': [df, {doc_id: tf}]}
+        inv_index: an inverted index of the form {'term': (df, doc_ids, tfs)}
         outfile: (str) the path to the file to be created
     """
-    f = open(outfile, 'w')
-    for t in inv_index:
-        f.write({t: inv_index[t]}.__str__() + '\n')
-    f.close()
+    with open(outfile, 'wb') as f:
+        pickle.dump(inv_index, f, protocol=4)
+
+
+# Bloom pre-filter parameters: 2048-bit filters (kept as plain int bitsets)
+# with three hash probes give a low false-positive rate for posting lists of
+# up to a few hundred documents.
+BLOOM_BITS = 2048
+BLOOM_HASHES = 3
+
+# Bloom filters for the index currently in use, stored next to a reference
+# to the index they were built from: pairing by identity (not id()) means a
+# rebuilt or reloaded index can never pick up stale filters, and the single
+# slot keeps the registry bounded.
+_blooms = {'index': None, 'filters': None}
+
+
+def make_bloom(doc_ids):
+    """Build a Bloom filter over the given doc ids, as an int bitset.
+    Arguments:
+        doc_ids: an iterable of document ids
+    Return:
+        an int with BLOOM_HASHES bits set per doc id
+    """
+    bloom = 0
+    for doc_id in doc_ids:
+        for probe in range(BLOOM_HASHES):
+            bloom |= 1 << (hash((probe, doc_id)) % BLOOM_BITS)
+    return bloom
+
+
+def build_blooms(inv_index):
+    """Build the per-term Bloom filters for the given inverted index and
+    register them for eval_conj's pre-filter. Called whenever an index is
+    created or loaded, so queries never pay the build cost.
+    Arguments:
+        inv_index: an inverted index
+    Return:
+        a dictionary {term: bloom} of int bitsets
+    """
+    filters = {t: make_bloom(entry[1]) for t, entry in inv_index.items()}
+    _blooms['index'] = inv_index
+    _blooms['filters'] = filters
+    return filters
+
+
+def get_blooms(inv_index):
+    """Return the Bloom filters belonging to the given inverted index,
+    rebuilding them if the registered filters were built from another index.
+    Arguments:
+        inv_index: an inverted index
+    Return:
+        a dictionary {term: bloom} of int bitsets
+    """
+    if _blooms['index'] is inv_index:
+        return _blooms['filters']
+    return build_blooms(inv_index)
 
 
 def eval_conj(inv_index, terms):
@@ -148,17 +259,39 @@ def eval_conj(inv_index, terms):
         a set of (docId, score) tuples -- You can ignore `score` by
         substituting it with None
     """
-    matches = {}
-    # Get the posting "lists" for each of the ANDed terms
-    postings = {}
-    for t in terms:
-        if t not in inv_index:
-            postings[t] = {}
+    terms = list(terms)
+    # Any term absent from the index can match no document, so the whole
+    # conjunction is empty -- return before doing any posting-list work:
+    if any(t not in inv_index for t in terms):
+        return set()
+    # Bloom pre-filter: if the query terms' filters AND down to zero, no
+    # document can contain all of them, so skip the posting lists entirely.
+    if terms:
+        blooms = get_blooms(inv_index)
+        combined = -1
+        for t in terms:
+            combined &= blooms[t]
+        if combined == 0:
+            return set()
+    # Get the sorted posting lists for each of the ANDed terms
+    postings = [inv_index[t][1] for t in terms]
+    postings.sort(key=len)
+    if not postings:
+        return set()
+    # Basic boolean - no scores. Walk the shortest list and binary-search each
+    # of its doc ids in the longer lists -- O(|smallest| * log |larger|). The
+    # pivot ids are ascending, so each search resumes from the previous hit:
+    pivot, others = postings[0], postings[1:]
+    lows = [0] * len(others)
+    matches = []
+    for docid in pivot:
+        for j, lst in enumerate(others):
+            i = bisect_left(lst, docid, lows[j])
+            lows[j] = i
+            if i == len(lst) or lst[i] != docid:
+                break
         else:
-            postings[t] = inv_index[t][1]
-    # Basic boolean - no scores:
-    docid_sets = [set(postings[t].keys()) for t in postings]
-    matches = set.intersection(*docid_sets)
+            matches.append(docid)
     return {(docid, None) for docid in matches}
 
 
@@ -189,7 +322,7 @@ def main():
     # and write it into a file
     inv_index = None
     if not os.path.isfile(INDEX_FILE):
-        doc_kwds, title_kwds = parse_documents()
+        doc_kwds, title_kwds = load_tokens()
         inv_index = create_inv_index(doc_kwds, title_kwds)
         write_inv_index(inv_index)
     else:
@@ -202,15 +335,17 @@ def main():
     # the case of ranked solutions they should be reverse-sorted by score
     # (documents with higher scores should appear before documents with lower
     # scores).
-    replies = []
-    for l in sys.stdin:
-        replies.append(eval_conj(inv_index, pre_process(l.split())))
+    # Read all queries in one go, skipping blank lines. Queries are still
+    # pre-processed per line (the filters drop tokens, so batching them all
+    # together would lose the line boundaries), but the shared stem cache
+    # keeps terms repeated between queries warm.
+    queries = [l.split() for l in sys.stdin.read().splitlines() if l.strip()]
+    replies = [eval_conj(inv_index, pre_process(q)) for q in queries]
     if len(replies) > 0:
         or_replies = eval_disj(replies)
-        print reduce(lambda x, y: str(x) + ' ' + str(y), sorted([x[0] for x in
-                     or_replies]), '')
+        print(' '.join(str(docid) for docid, _ in sorted(or_replies)))
     else:
-        print
+        print()
 
 
 if __name__ == '__main__':
@@ -1,24 +1,90 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from __future__ import print_function
 import sys
 import re
-import itertools
-import ast
 import os.path
 import math
+import pickle
+import numpy as np
+from functools import lru_cache
 from nltk.stem.porter import PorterStemmer
 from nltk.corpus import stopwords
-from collections import defaultdict
-from itertools import groupby
+from collections import Counter, defaultdict
+from multiprocessing import Pool
 from operator import itemgetter
 
 
 CRAN_COLL = '/home/mscuser/Datasets/cran/cran.all.1400'
-INDEX_FILE = 'cran.ind'
+# The Ranked and Boolean modules store their indexes in different formats
+# (numpy arrays plus bitmaps here, sorted lists there), so each keeps its
+# own files
+
+INDEX_FILE = 'cran.ranked.ind'
+TOKENS_FILE = 'cran.ranked.tokens.pkl'
+
+TOTAL_DOCUMENTS = 1400
+
+# Every posting list also gets a bitmap with one bit per document id (ids
+# start at 1), padded up to a whole number of bytes: at 1400 documents a
+# whole conjunction collapses to a few word-wise ANDs over 176-byte arrays
+
+BITMAP_BYTES = (TOTAL_DOCUMENTS // 8) + 1
 
 SYMBOLS = '!@#$%^&*()[]{};\':",.<>/?`~-_=+'
 
+# Pre-compiled patterns for the Cranfield section delimiters: every document
+# starts with ".I <id>", its title lies between ".T" and ".A" and its body
+# runs from ".W" until the next document
+
+DOC_SEP_RE = re.compile(r'\.I (\d+)\n')
+TITLE_RE = re.compile(r'\.T\n(.*?)\n\.A\n', re.DOTALL)
+BODY_RE = re.compile(r'\.W\n(.*)', re.DOTALL)
+
+# Load the stop-word corpus and build the stemmer once at import time, instead
+# of repeating the (expensive) NLTK setup on every pre_process() call. The
+# translation table removes every symbol with one C-level str.translate call
+
+STOP_WORDS = frozenset(stopwords.words('english'))
+STEMMER = PorterStemmer()
+SYMBOLS_TABLE = str.maketrans('', '', SYMBOLS)
+
+
+def _accumulate_scores(doc_ids, tfs, conj_ids, idf, scores):
+    """Add one term's tf-idf contribution, idf * (1 + log10(tf)), to the
+    running scores of the surviving doc ids. Numpy fallback; replaced below
+    by a JIT-compiled kernel when numba is installed."""
+    positions = np.searchsorted(doc_ids, conj_ids)
+    scores += (1 + np.log10(tfs[positions].astype(np.float64))) * idf
+
+
+try:
+    from numba import njit
+except ImportError:
+    pass
+else:
+    @njit(cache=True)
+    def _accumulate_scores(doc_ids, tfs, conj_ids, idf, scores):
+        # Tight compiled loop: binary-search each surviving id in the term's
+        # sorted doc-id array and accumulate its tf-idf score in place
+        for i in range(conj_ids.size):
+            target = conj_ids[i]
+            lo = 0
+            hi = doc_ids.size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if doc_ids[mid] < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            scores[i] += (1.0 + math.log10(float(tfs[lo]))) * idf
+
+
+@lru_cache(maxsize=100000)
+def _stem(word):
+    """Stem the given word, memoizing the result: the collection repeats the
+    same tokens many times over, so most stem calls become cache hits."""
+    return STEMMER.stem(word)
+
 
 def parse_documents(cran_file=CRAN_COLL):
     """Parse the document body and title fields of the Cranfield collection.
@@ -28,56 +94,26 @@ def parse_documents(cran_file=CRAN_COLL):
         (body_kwds, title_kwds): where body_kwds and title_kwds are
         dictionaries of the form {docId: [words]}.
     """
-    id_term_list_body = []
-    id_term_list_title = [] 
-    in_text_body = 0
-    in_text_title = 0  
     body_kwds = {}
     title_kwds = {}
-    
-    # Open the cran file, read the titles and the bodies without the lines with the delimeters and store them in lists
- 
+
+    # Read the cran file in one go and split it once on the ".I <id>" markers,
+    # so the pieces alternate between a document id and that document's text
+
     with open(cran_file) as cran_file:
-        listoflines = cran_file.read().splitlines()
-        for each_line in listoflines:
-              if each_line.startswith('.I'):
-                  in_text_body = 0
-                  in_text_title = 0
-                  document_id = int(re.search(r'\d+', each_line).group())
-                  continue
-              else:
-                  if each_line.startswith('.T'):
-                      in_text_title = 1
-                      continue
-              if in_text_title == 1:
-                  if each_line.startswith('.A'):
-                      in_text_title = 0
-                      continue
-                  words_title = each_line.split()
-                  title_tuples = [(document_id,each_word) for each_word in words_title]
-                  for each_title_tuple in title_tuples:
-                      id_term_list_title.append(each_title_tuple)
-              else:
-                  if each_line.startswith('.W'):
-                      in_text_body = 1
-                      continue
-              if in_text_body == 1:
-                  if each_line.startswith('.I'):
-                      in_text_body = 0
-                      continue
-                  words_body = each_line.split()
-                  body_tuples = [(document_id,each_word) for each_word in words_body]
-                  for each_body_tuple in body_tuples:
-                      id_term_list_body.append(each_body_tuple)
-
-    # Convert the lists into dictionaries
-
-    for a, b in id_term_list_title:
-        title_kwds.setdefault(a, []).append(b)
-
-    for a, b in id_term_list_body:
-        body_kwds.setdefault(a, []).append(b)
-   
+        whole_text = cran_file.read()
+    pieces = DOC_SEP_RE.split(whole_text)[1:]
+
+    # Pull the title and body sections out of each document with the
+    # pre-compiled patterns and tokenize each section with a single split
+
+    for document_id, document_text in zip(pieces[::2], pieces[1::2]):
+        document_id = int(document_id)
+        title_match = TITLE_RE.search(document_text)
+        body_match = BODY_RE.search(document_text)
+        title_kwds[document_id] = title_match.group(1).split() if title_match else []
+        body_kwds[document_id] = body_match.group(1).split() if body_match else []
+
     return (title_kwds, body_kwds)
    
 def pre_process(words):
@@ -87,28 +123,59 @@ def pre_process(words):
     Return:
         a shorter list of pre-processed words
     """
-    # Get list of stop-words and instantiate a stemmer:
-    stop_words = set(stopwords.words('english'))
-    stemmer = PorterStemmer()
+    # Make all lower-case and remove symbols everywhere in the token (the old
+    # strip(SYMBOLS) only looked at the edges), then drop words <= 3
+    # characters and stopwords and stem the rest -- all in a single pass
 
-    # Make all lower-case:
-    words = map(lambda x:x.lower(),words)
-    
-    # Remove symbols:
-    words = [each_string.strip(SYMBOLS) for each_string in words]
-    
-    # Remove words <= 3 characters:
-    words = [each_string for each_string in words if len(each_string) > 3]
-   
-    # Remove stopwords:
-    words = [each_string for each_string in words if each_string not in stop_words]
-  
-    # Stem terms:
-    words = map(lambda x: (stemmer.stem(x)), words)
+    cleaned = (each_string.lower().translate(SYMBOLS_TABLE) for each_string in words)
+    words = [_stem(each_string) for each_string in cleaned if len(each_string) > 3 and each_string not in STOP_WORDS]
 
     return (words)
  
 
+def _pp_one(item):
+    """Pre-process a single (doc_id, words) pair. Defined at module level so
+    it pickles cleanly for the multiprocessing workers."""
+    doc_id, words = item
+    return (doc_id, pre_process(words))
+
+
+def load_tokens(cran_file=CRAN_COLL, tokens_file=TOKENS_FILE):
+    """Parse and pre-process the collection, caching the result on disk.
+    The sidecar pickle keeps the source file's modification time next to the
+    pre-processed keyword dictionaries, so a rerun of the index build skips
+    the parsing and stemming work unless the collection itself has changed.
+    Arguments:
+        cran_file: (str) the path to the Cranfield collection file
+        tokens_file: (str) the path of the token cache sidecar
+    Return:
+        (title_kwds, body_kwds): dictionaries of the form {docId: [terms]}
+        with pre-processed terms.
+    """
+    mtime = os.path.getmtime(cran_file)
+
+    # Reuse the cached tokens if the collection has not changed since
+
+    if os.path.exists(tokens_file):
+        with open(tokens_file, 'rb') as f:
+            cached_mtime, titles_parsed, bodies_parsed = pickle.load(f)
+        if cached_mtime == mtime:
+            return (titles_parsed, bodies_parsed)
+
+    # Otherwise parse and pre-process the collection and refresh the cache.
+    # Every document is pre-processed independently, so the (cold) build path
+    # spreads the work across the available cores
+
+    titles, bodies = parse_documents(cran_file)
+    with Pool() as pool:
+        titles_parsed = dict(pool.imap_unordered(_pp_one, titles.items(), chunksize=64))
+        bodies_parsed = dict(pool.imap_unordered(_pp_one, bodies.items(), chunksize=64))
+    with open(tokens_file, 'wb') as f:
+        pickle.dump((mtime, titles_parsed, bodies_parsed), f, protocol=4)
+
+    return (titles_parsed, bodies_parsed)
+
+
 def create_inv_index(bodies, titles):
     """Create a single inverted index for the dictionaries provided. Treat
     all keywords as if they come from the same field. In the inverted index
@@ -119,77 +186,91 @@ def create_inv_index(bodies, titles):
         titles: A dictionary of the form {doc_id: [terms]} for the terms found
         in the title (.T) of a document
     Return:
-        index: a dictionary {docId: [df, postings]}, where postings is a
-        dictionary {docId: tf}.
-        E.g. {'word': [3, {4: 2, 7: 1, 9: 3}]}
-               ^       ^   ^        ^
-               term    df  docid    tf
+        index: a dictionary {term: (df, doc_ids, tfs, bitmap)}, where doc_ids
+        is a sorted numpy int32 array of the ids of the documents containing
+        the term, tfs is a parallel int16 array with the term frequencies and
+        bitmap is a packed uint8 array with one bit set per posting doc id.
+        E.g. {'word': (3, array([4, 7, 9]), array([2, 1, 3]), array(...))}
+               ^       ^         ^                 ^           ^
+               term    df        docids            tfs         bitmap
     """
-    # Create a joint dictionary with pre-processed terms 
-    
-    joint_dictionary = {doc_id_titles : lst_titles + lst_bodies for doc_id_titles, lst_titles in titles.items() for doc_id_bodies, lst_bodies in bodies.items() if doc_id_titles == doc_id_bodies}
+    # Create a joint dictionary with pre-processed terms
 
-    # Create a list terms[] with the unique terms of the dictionary 
+    joint_dictionary = {doc_id : lst_titles + bodies.get(doc_id, []) for doc_id, lst_titles in titles.items()}
 
-    terms = []
-    for lst in joint_dictionary.values():
-        for term in lst:
-            terms.append(term)
-    terms = set(terms)
-    terms = list(terms)
-    
-    # Create the inverted indexes and call the function that writes them in a file
-    
-    tf = 0
-    dictionary_instance = {}
-
-    for term in terms:
-        for number, lst in joint_dictionary.items():
-            for word in lst:
-                if word == term:
-                    tf += 1
-                    dictionary_instance[number] = tf
-            tf = 0
-        df = len(dictionary_instance.keys())
-        inv_index = {term : [df, dictionary_instance]}
-        dictionary_instance = {}
-        write_inv_index(inv_index, INDEX_FILE)
+    # Count the term frequencies of each document with a Counter and merge
+    # them into the per-term postings, one entry per (term, document) pair
+
+    counts = defaultdict(dict)
+
+    for doc_id, lst in joint_dictionary.items():
+        for term, tf in Counter(lst).items():
+            counts[term][doc_id] = tf
+
+    # Convert each term's postings to a structure-of-arrays layout: parallel
+    # numpy arrays of doc ids and term frequencies, sorted by doc id, plus a
+    # packed bitmap of the doc ids for the eval_conj fast path. Compact
+    # arrays take far less memory than one dictionary per term and intersect
+    # at C speed in eval_conj
+
+    inv_index = {}
+
+    for term, postings in counts.items():
+        sorted_ids = sorted(postings)
+        doc_ids = np.array(sorted_ids, dtype=np.int32)
+        tfs = np.array([postings[doc_id] for doc_id in sorted_ids], dtype=np.int16)
+        bits = np.zeros(BITMAP_BYTES * 8, dtype=np.uint8)
+        bits[doc_ids] = 1
+        inv_index[term] = (len(sorted_ids), doc_ids, tfs, np.packbits(bits))
+
+    # Call the function that writes the whole inverted index in a file
+
+    write_inv_index(inv_index, INDEX_FILE)
 
        
+# Cache of already-loaded indexes, keyed by filename and the file's mtime at
+# load time, so repeated main() runs in one process skip the reload
+
+_index_cache = {}
+
+
 def load_inv_index(filename=INDEX_FILE):
-    """Load an inverted index from the disk. The index is assummed to be stored
-    in a text file with one line per keyword. Each line is expected to be
-    `eval`ed into a dictionary of the form created by create_inv_index().
+    """Load an inverted index from the disk. The index is assummed to be
+    stored as a single pickled dictionary of the form created by
+    create_inv_index(). Unchanged files are served from an in-process cache.
 
     Arguments:
         filename: the path of the inverted index file
     Return:
         a dictionary containing all keyworks and their posting dictionaries
     """
-    whole_dictionary = {}
-    
-    # Open the file with the inverted indexes and store them in a dictionary
+    mtime = os.path.getmtime(filename)
+    cached = _index_cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return (cached[1])
+
+    # Open the file with the inverted index and unpickle the whole dictionary
 
-    with open(filename) as index_file:
-        lines = index_file.read().splitlines()
-        for each_line in lines:
-            each_line = ast.literal_eval(each_line)
-            whole_dictionary.update(each_line)
+    with open(filename, 'rb') as index_file:
+        whole_dictionary = pickle.load(index_file)
+    _index_cache[filename] = (mtime, whole_dictionary)
 
     return (whole_dictionary)
 
 def write_inv_index(inv_index, outfile=INDEX_FILE):
-    """Write the given inverted index in a file.
+    """Write the given inverted index in a file, as one pickled dictionary
+    (pickle stores the numpy posting arrays intact).
     Arguments:
-        inv_index: an inverted index of the form {'term': [df, {doc_id: tf}]}
+        inv_index: an inverted index of the form
+        {'term': (df, doc_ids, tfs, bitmap)}
         outfile: (str) the path to the file to be created
     """
 
-    # Open a file in which the inverted indexes are written
+    # Pickle the whole index in one go instead of formatting one line per term
+
+    with open(outfile, 'wb') as f:
+        pickle.dump(inv_index, f, protocol=4)
 
-    f = open(outfile, 'a')
-    f.write(str(inv_index) + '\n')
-    
 
 
 def eval_conj(inv_index, terms):
@@ -203,45 +284,32 @@ def eval_conj(inv_index, terms):
         a set of (docId, score) tuples -- You can ignore `score` by
         substituting it with None
     """
-    num_ids = []
-    tf_idf_list = []
-    conj_ids = set()
-    total_documents = 1400
+    # Create the array conj_ids with the ids that are common for each term:
+    # AND the per-term bitmaps word-wise (a handful of vector operations at
+    # this collection size) and unpack the surviving bits back into doc ids
 
-    # Create a list num_ids which contains lists of the document ids that every terms appears in
+    entries = [inv_index[word] for word in terms if word in inv_index]
 
-    for word in terms:
-        for term, value in inv_index.iteritems():
-            if word == term:
-                num_ids.append(value[1].keys())
-      
-    # Create the set conj_ids with the ids that are common for each term 
-
-    if len(num_ids)>=1:
-        conj_ids = set(num_ids[0]).intersection(*num_ids[1:]) 
-    else:
-        conj_ids = set()
-
-    # Calculates the tf_idf for every term for every mutual document id and stores it together with the id as a tuple in a list 
-
-    for word in terms:
-        for term, value in inv_index.iteritems():
-            if word == term:
-                idf = math.log10(total_documents / value[0])
-                for oneid in conj_ids:
-                    for key, freq in value[1].iteritems():
-                        if oneid == key:
-                            tf = 1 + math.log10(freq)
-                            tf_idf = tf * idf
-                            tup = (oneid, tf_idf)
-                            tf_idf_list.append(tup)
-
-    # Groups the same ids and then sums the tf_idf scores
-
-    tf_idf_list.sort(key=itemgetter(0)) 
-    grouped_by = groupby(tf_idf_list, key=itemgetter(0))
-    numbers = [(key, [t[1] for t in items]) for key, items in grouped_by]
-    conj_results = [(key, sum(items)) for key, items in numbers]
+    if not entries:
+        return ([])
+    acc = entries[0][3].copy()
+    for entry in entries[1:]:
+        acc &= entry[3]
+    conj_ids = np.flatnonzero(np.unpackbits(acc)).astype(np.int32)
+    if conj_ids.size == 0:
+        return ([])
+
+    # Sum every term's tf_idf contribution over the surviving ids with the
+    # scoring kernel (every indexed term contains all surviving ids, since
+    # conj_ids is their intersection)
+
+    scores = np.zeros(conj_ids.size)
+
+    for df, doc_ids, tfs, bitmap in entries:
+        idf = math.log10(TOTAL_DOCUMENTS / df)
+        _accumulate_scores(doc_ids, tfs, conj_ids, idf, scores)
+
+    conj_results = list(zip(conj_ids.tolist(), scores.tolist()))
 
     return (conj_results)
 
@@ -258,16 +326,15 @@ def eval_disj(conj_results):
         a set of (docId, score) tuples - You can ignore `score` by substituting
         it with None
     """
-    # Flattens the list of lists of tuples which are returned from the eval_conj(s)
-
-    conj_results = [y for x in conj_results for y in x]   
-    
-    # Groups the same ids and then takes the max tf_idf score
+    # Keeps, for every id seen in any of the conjunction results, the max
+    # tf_idf score -- a single pass instead of flatten, sort and groupby
 
-    conj_results.sort(key=itemgetter(0)) 
-    grouped_by = groupby(conj_results, key=itemgetter(0))
-    numbers = [(key, [t[1] for t in items]) for key, items in grouped_by]
-    disj_results = [(key, max(items)) for key, items in numbers]
+    best_scores = {}
+    for results in conj_results:
+        for doc_id, score in results:
+            if doc_id not in best_scores or score > best_scores[doc_id]:
+                best_scores[doc_id] = score
+    disj_results = list(best_scores.items())
 
     return (disj_results)
 
@@ -278,14 +345,10 @@ def main():
     ORed. Match the user query to the Cranfield collection and output matching
     documents as "ID: title", each on its own line, on stdout.
     """
-    conj_eval = []
-
     # If an index file exists load it; otherwise create a new inverted index and write it into a file
 
-    if os.path.exists("cran.ind") == False:
-        titles, bodies = parse_documents()
-        titles_parsed = {docid : pre_process(lst) for docid, lst in titles.items()}
-        bodies_parsed = {docid : pre_process(lst) for docid, lst in bodies.items()}
+    if os.path.exists(INDEX_FILE) == False:
+        titles_parsed, bodies_parsed = load_tokens()
         create_inv_index(bodies_parsed, titles_parsed)
 
     # Load the inverted index into a dictionary
@@ -295,18 +358,15 @@ def main():
     # Gets and evaluates user queries from stdin. Terms on each line are ANDed, while results between lines are ORed.
     # The output is a space-separated list of, reverse-sorted by score, document IDs.
     
-    user_input = sys.stdin.readlines()
-    for lst_and_words in user_input:
-        lst_and_words = lst_and_words.splitlines()
-        lst_and_words = lst_and_words[0].split()
-        lst_and_words = pre_process(lst_and_words)
-        conj_eval.append(eval_conj(whole_dictionary, lst_and_words))
-            
+    # Read all the queries in one go, skipping blank lines, and evaluate them
+    # as a batch; the shared stem cache keeps terms repeated between queries warm
+
+    queries = [each_line.split() for each_line in sys.stdin.read().splitlines() if each_line.strip()]
+    conj_eval = [eval_conj(whole_dictionary, pre_process(each_query)) for each_query in queries]
+
     disj_eval = eval_disj(conj_eval)
     disj_eval.sort(key=itemgetter(1), reverse=True)
-    for answer in disj_eval:
-        print (str(answer[0]), end=' ')
-    print ("\n")
+    print (' '.join(str(answer[0]) for answer in disj_eval))
         
 
 if __name__ == '__main__':